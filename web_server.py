@@ -4,20 +4,419 @@
 import os
 import sys
 import json
-import base64
+import re
+import shutil
+import socket
 import subprocess
+import threading
+import time
+import queue
 from pathlib import Path
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
 import mimetypes
+import functools
+import collections
 import tempfile
-import uuid
+import secrets
 from datetime import datetime
 
+# مجلد المشروع، يُحسب مرة واحدة عند الاستيراد
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+
+# استخدام pybase64 (SIMD) إن توفرت، وإلا فالمكتبة القياسية
+try:
+    from pybase64 import b64decode
+except ImportError:
+    from base64 import b64decode
+
+# استخدام orjson لترميز استجابات JSON إن توفرت
+try:
+    import orjson
+    
+    def dumps_json(data):
+        return orjson.dumps(data)
+except ImportError:
+    def dumps_json(data):
+        return json.dumps(data, ensure_ascii=False).encode('utf-8')
+
+# حجم بداية الطلب التي يُبحث فيها عن مفتاح الصورة، وحجم دفعات القراءة
+ENVELOPE_HEAD_SIZE = 512
+STREAM_CHUNK_SIZE = 64 * 1024
+DATA_URL_PREFIX_MAX = 64
+JSON_WHITESPACE = b' \t\r\n'
+
+# تهريبات JSON داخل سلسلة base64 (مثل \/ أو \n لفواصل أسطر MIME)
+JSON_ESCAPE = re.compile(rb'\\(u[0-9a-fA-F]{4}|.)', re.S)
+JSON_SIMPLE_ESCAPES = {
+    ord('"'): ord('"'), ord('\\'): ord('\\'), ord('/'): ord('/'),
+    ord('b'): 8, ord('f'): 12, ord('n'): 10, ord('r'): 13, ord('t'): 9,
+}
+BASE64_CHARS = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/='
+NON_BASE64_CHARS = bytes(c for c in range(256) if c not in BASE64_CHARS)
+
+# عدد خيوط تشغيل Real-ESRGAN المتزامنة على GPU (بقية الطلبات تُخدم بالتوازي)
+GPU_SLOTS = int(os.environ.get('GPU_SLOTS', 1))
+
+# مدة انتظار صور إضافية لتجميعها في استدعاء واحد، والحد الأقصى للدفعة
+BATCH_WINDOW = int(os.environ.get('BATCH_WINDOW_MS', 50)) / 1000
+BATCH_MAX_SIZE = 8
+
+# أوزان نموذج PyTorch لتشغيل Real-ESRGAN داخل العملية (اختياري)
+MODEL_PATH = os.environ.get(
+    'REALESRGAN_MODEL_PATH',
+    os.path.join(BASE_PATH, 'weights', 'RealESRGAN_x4plus.pth')
+)
+# فرض التشغيل داخل العملية حتى دون CUDA (وإلا يُفضل ncnn-vulkan على GPU)
+IN_PROCESS = os.environ.get('REALESRGAN_IN_PROCESS', '0') == '1'
+
+
+def find_image_payload(head):
+    """مسح خطي لبداية الغلاف {"image": "data:...;base64,...
+    
+    يُرجع موضع بداية بيانات base64، أو -1 إن لم يطابق الغلاف هذا الشكل
+    (فيُستخدم json.loads بدلاً منه).
+    """
+    pos = 0
+    size = len(head)
+    for token in (b'{', b'"image"', b':', b'"'):
+        while pos < size and head[pos] in JSON_WHITESPACE:
+            pos += 1
+        if not head.startswith(token, pos):
+            return -1
+        pos += len(token)
+    # إزالة البادئة data:image/...;base64, (البادئات الأطول من الحد تُترك لـ json.loads)
+    if head.startswith(b'data:', pos):
+        comma = head.find(b',', pos, pos + DATA_URL_PREFIX_MAX)
+        if comma < 0:
+            return -1
+        pos = comma + 1
+    return pos
+
+
+def unescape_json_char(match):
+    """فك تهريب حرف واحد، مع إسقاط ما ليس من أحرف base64 (يتجاهله فك التشفير أصلاً)"""
+    escape = match.group(1)
+    if len(escape) == 5:
+        char = int(escape[1:], 16)
+    else:
+        char = JSON_SIMPLE_ESCAPES.get(escape[0])
+        if char is None:
+            raise json.JSONDecodeError('Invalid \\escape', '', 0)
+    return bytes([char]) if char < 128 and char in BASE64_CHARS else b''
+
+
+def unescape_base64(data):
+    """إزالة تهريب JSON وكل ما ليس من أحرف base64 (كالمسافات) للحفاظ على محاذاة الأحرف"""
+    if b'\\' in data:
+        data = JSON_ESCAPE.sub(unescape_json_char, data)
+    return data.translate(None, NON_BASE64_CHARS)
+
+
+def backslash_run(data, end):
+    """عدد الشرطات المائلة العكسية المتتالية المنتهية عند الموضع end"""
+    count = 0
+    while end >= 0 and data[end] == 0x5C:
+        count += 1
+        end -= 1
+    return count
+
+
+def find_string_end(data):
+    """موضع أول علامة تنصيص غير مهربة، أو -1"""
+    pos = data.find(b'"')
+    while pos > 0 and backslash_run(data, pos - 1) % 2:
+        pos = data.find(b'"', pos + 1)
+    return pos
+
+
+def incomplete_escape_start(data):
+    """موضع تهريب غير مكتمل في آخر البيانات (يُكمل مع الدفعة التالية)، أو طول البيانات"""
+    idx = data.rfind(b'\\', max(0, len(data) - 6))
+    if idx < 0 or backslash_run(data, idx) % 2 == 0:
+        return len(data)
+    if idx + 1 == len(data) or (data[idx + 1] == ord('u') and len(data) < idx + 6):
+        return idx
+    return len(data)
+
+
+# سجل الطلبات: يُضاف إلى طابور في الذاكرة ويُكتب من خيط منفصل (ACCESS_LOG=0 لتعطيله)
+# أما الأخطاء فتُكتب فوراً دائماً
+ACCESS_LOG = os.environ.get('ACCESS_LOG', '1') != '0'
+LOG_BUFFER = collections.deque(maxlen=4096)
+LOG_FLUSH_INTERVAL = 0.05
+
+
+def format_log_line(timestamp, format, args):
+    """تنسيق سطر سجل بختم زمني"""
+    timestamp = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+    return f"[{timestamp}] {format % args}\n"
+
+
+def flush_log_buffer():
+    """تنسيق الرسائل المتراكمة وكتابتها دفعة واحدة"""
+    lines = []
+    while True:
+        try:
+            timestamp, format, args = LOG_BUFFER.popleft()
+        except IndexError:
+            break
+        lines.append(format_log_line(timestamp, format, args))
+    if lines:
+        sys.stdout.write(''.join(lines))
+        sys.stdout.flush()
+
+
+def log_writer():
+    """خيط كتابة السجل"""
+    while True:
+        time.sleep(LOG_FLUSH_INTERVAL)
+        flush_log_buffer()
+
+
+class RealESRGANBatcher:
+    """تجميع الصور الواردة خلال نافذة قصيرة ومعالجتها في استدعاء واحد لـ Real-ESRGAN"""
+    
+    def __init__(self, base_path, workers=1):
+        self.base_path = Path(base_path)
+        self.exe_path = self.base_path / 'realesrgan-ncnn-vulkan.exe'
+        self.workers = workers
+        self.queue = queue.Queue()
+        self.started = False
+        self.lock = threading.Lock()
+    
+    def start(self):
+        """تشغيل خيوط المعالجة مرة واحدة"""
+        with self.lock:
+            if self.started:
+                return
+            for _ in range(self.workers):
+                threading.Thread(target=self.worker, daemon=True).start()
+            self.started = True
+    
+    def submit(self, input_path, output_path):
+        """إضافة صورة إلى الطابور وانتظار نتيجتها"""
+        self.start()
+        job = {
+            'input': Path(input_path),
+            'output': Path(output_path),
+            'done': threading.Event(),
+            'result': (False, "خطأ غير معروف"),
+        }
+        self.queue.put(job)
+        job['done'].wait()
+        return job['result']
+    
+    def worker(self):
+        """جمع الطلبات المتقاربة زمنياً ثم معالجتها كدفعة"""
+        while True:
+            jobs = [self.queue.get()]
+            deadline = time.monotonic() + BATCH_WINDOW
+            while len(jobs) < BATCH_MAX_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    jobs.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            
+            # كل دفعة تُخرج صيغة واحدة
+            groups = {}
+            for job in jobs:
+                fmt = job['output'].suffix.lstrip('.').lower() or 'png'
+                groups.setdefault(fmt, []).append(job)
+            
+            for fmt, group in groups.items():
+                try:
+                    self.run_batch(fmt, group)
+                except Exception as e:
+                    print(f"Exception in Real-ESRGAN batch: {e}")
+                    # عدم المساس بالصور التي نُقلت بنجاح إلى مجلد النتائج
+                    for job in group:
+                        if not job['result'][0]:
+                            job['result'] = (False, str(e))
+                finally:
+                    for job in group:
+                        job['done'].set()
+    
+    def run_batch(self, fmt, jobs):
+        """تشغيل Real-ESRGAN مرة واحدة على مجلد يضم صور الدفعة"""
+        batch_name = f'batch_{secrets.token_urlsafe(12)}'
+        input_dir = self.base_path / 'temp' / batch_name
+        # مجلد الإخراج بجانب مجلد النتائج (قد يكون قرصاً مستقلاً كما في render.yaml)
+        # حتى يبقى نقل الصور إليه إعادة تسمية على نفس القرص
+        output_dir = jobs[0]['output'].parent / f'.{batch_name}'
+        input_dir.mkdir(parents=True)
+        output_dir.mkdir()
+        
+        try:
+            for index, job in enumerate(jobs):
+                os.replace(job['input'], input_dir / f"{index}{job['input'].suffix}")
+            
+            cmd = [
+                str(self.exe_path),
+                '-i', str(input_dir),
+                '-o', str(output_dir),
+                '-n', 'realesrgan-x4plus',
+                '-t', '256',  # تقليل حجم البلاط لتسريع المعالجة
+                '-j', '1:1:1',  # استخدام خيط واحد لكل GPU لتحسين الاستقرار
+                '-f', fmt
+            ]
+            
+            print(f"Running command ({len(jobs)} images): {' '.join(cmd)}")
+            
+            # تجاهل مخرجات التقدم، والاحتفاظ بنهاية رسائل الخطأ فقط عند الفشل
+            result = subprocess.run(
+                cmd,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                close_fds=True,
+                cwd=str(self.base_path),
+                env=NCNN_ENV
+            )
+            
+            error_msg = None
+            if result.returncode != 0:
+                error_msg = result.stderr[-4096:].decode('utf-8', 'replace') or "خطأ غير معروف"
+                print(f"Real-ESRGAN error: {error_msg}")
+            
+            for index, job in enumerate(jobs):
+                # نجاح النقل هو التحقق الوحيد من وجود الصورة المحسنة
+                try:
+                    shutil.move(str(output_dir / f'{index}.{fmt}'), str(job['output']))
+                    job['result'] = (True, None)
+                except FileNotFoundError:
+                    job['result'] = (False, error_msg or "لم يتم إنشاء الصورة المحسنة")
+                except OSError as e:
+                    print(f"Error moving Real-ESRGAN output: {e}")
+                    job['result'] = (False, str(e))
+        finally:
+            shutil.rmtree(input_dir, ignore_errors=True)
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+
+# منع مجمّع خيوط OpenMP في ncnn من مزاحمة خيوط الخادم
+NCNN_ENV = dict(os.environ, OMP_NUM_THREADS='1')
+
+BATCHER = RealESRGANBatcher(BASE_PATH, workers=GPU_SLOTS)
+
+UPSAMPLER = None
+UPSAMPLER_LOCK = threading.Lock()
+INFERENCE_LOCK = threading.Lock()
+
+
+def load_upsampler():
+    """تحميل نموذج Real-ESRGAN داخل العملية مرة واحدة، أو None إن لم يتوفر أو لم يُفضّل
+    
+    يُستخدم النموذج داخل العملية فقط مع CUDA، أو عند غياب ملف ncnn-vulkan، أو مع
+    REALESRGAN_IN_PROCESS=1؛ فنسخة torch على ويندوز تعمل على المعالج وهي أبطأ بكثير.
+    """
+    global UPSAMPLER
+    if UPSAMPLER is not None:
+        return UPSAMPLER or None
+    with UPSAMPLER_LOCK:
+        if UPSAMPLER is None:
+            UPSAMPLER = False
+            if os.path.exists(MODEL_PATH):
+                try:
+                    import torch
+                    
+                    if not (torch.cuda.is_available() or IN_PROCESS
+                            or not os.path.exists(BATCHER.exe_path)):
+                        raise RuntimeError("CUDA غير متوفر وملف ncnn-vulkan موجود")
+                    
+                    from basicsr.archs.rrdbnet_arch import RRDBNet
+                    from realesrgan import RealESRGANer
+                    
+                    model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64,
+                                    num_block=23, num_grow_ch=32, scale=4)
+                    UPSAMPLER = RealESRGANer(
+                        scale=4,
+                        model_path=MODEL_PATH,
+                        model=model,
+                        tile=256,  # نفس حجم البلاط المستخدم مع ncnn
+                        tile_pad=10,
+                        pre_pad=0,
+                        half=torch.cuda.is_available()
+                    )
+                    print(f"Real-ESRGAN backend: in-process PyTorch "
+                          f"({UPSAMPLER.device}) using {MODEL_PATH}")
+                except Exception as e:
+                    print(f"In-process Real-ESRGAN not used: {e}")
+            if not UPSAMPLER:
+                print(f"Real-ESRGAN backend: ncnn-vulkan ({BATCHER.exe_path})")
+        return UPSAMPLER or None
+
+
+def run_upsampler(upsampler, input_path, output_path):
+    """تحسين الصورة داخل العملية دون تشغيل برنامج خارجي"""
+    import cv2
+    
+    img = cv2.imread(input_path, cv2.IMREAD_UNCHANGED)
+    if img is None:
+        return False, "تعذر قراءة الصورة المدخلة"
+    
+    # RealESRGANer يحتفظ بحالة الصورة الحالية، لذا يُشغل طلب واحد في كل مرة
+    with INFERENCE_LOCK:
+        output, _ = upsampler.enhance(img)
+    
+    params = []
+    if output_path.lower().endswith(('.jpg', '.jpeg')):
+        params = [cv2.IMWRITE_JPEG_QUALITY, 90]
+    elif output_path.lower().endswith('.webp'):
+        params = [cv2.IMWRITE_WEBP_QUALITY, 90]
+    if not cv2.imwrite(output_path, output, params):
+        return False, "تعذر حفظ الصورة المحسنة"
+    return True, None
+
+# استجابات الأخطاء الثابتة مرمّزة مسبقاً
+ERROR_NO_IMAGE = dumps_json({'error': 'لم يتم العثور على بيانات الصورة'})
+ERROR_INVALID_JSON = dumps_json({'error': 'بيانات JSON غير صالحة'})
+ERROR_NOT_IMAGE = dumps_json({'error': 'نوع المحتوى يجب أن يكون صورة'})
+
+# بعض إصدارات بايثون لا تعرف امتداد webp
+mimetypes.add_type('image/webp', '.webp')
+
+# محتوى الملفات الثابتة (الواجهة) ونوعها، يُقرأ من القرص مرة واحدة
+STATIC_CACHE = {}
+
+
+@functools.lru_cache(maxsize=256)
+def guess_content_type(ext):
+    """تحديد نوع المحتوى من امتداد الملف"""
+    content_type, _ = mimetypes.guess_type('file' + ext)
+    return content_type or 'application/octet-stream'
+
+
+def load_static_file(file_path):
+    """قراءة ملف ثابت مع تخزينه في الذاكرة، وإرجاع (المحتوى، نوع المحتوى)"""
+    cached = STATIC_CACHE.get(file_path)
+    if cached is None:
+        with open(file_path, 'rb') as f:
+            content = f.read()
+        content_type = guess_content_type(os.path.splitext(file_path)[1].lower())
+        cached = STATIC_CACHE.setdefault(file_path, (content, content_type))
+    return cached
+
+
+class RealESRGANServer(ThreadingHTTPServer):
+    """خادم متعدد الخيوط يضبط مقابس الاتصالات لتقليل زمن الاستجابة"""
+    
+    def process_request(self, request, client_address):
+        try:
+            # إرسال الاستجابات الصغيرة فوراً دون انتظار خوارزمية Nagle
+            request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # مخزن إرسال أكبر لتنزيل الصور المحسنة
+            request.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+        except OSError:
+            pass
+        super().process_request(request, client_address)
+
+
 class RealESRGANHandler(BaseHTTPRequestHandler):
-    def __init__(self, *args, **kwargs):
-        self.base_path = Path(__file__).parent
-        super().__init__(*args, **kwargs)
+    # تجميع الرؤوس والجسم في كتابة واحدة (يُفرغ عند انتهاء الطلب)
+    wbufsize = 1 << 16
     
     def do_GET(self):
         """معالجة طلبات GET"""
@@ -25,37 +424,57 @@ class RealESRGANHandler(BaseHTTPRequestHandler):
         path = parsed_path.path
         
         if path == '/' or path == '/index.html':
-            self.serve_file('web_interface.html')
-        elif path.startswith('/results/'):
+            self.serve_file('web_interface.html', cache=True)
+        elif path.startswith('/results/') and '..' not in path:
             # تقديم الصور المحسنة
-            file_path = self.base_path / path[1:]  # إزالة الشرطة المائلة الأولى
-            if file_path.exists():
-                self.serve_file(str(file_path))
-            else:
-                self.send_error(404, "File not found")
+            self.serve_file(BASE_PATH + path)
         else:
             self.send_error(404, "Page not found")
     
     def do_POST(self):
         """معالجة طلبات POST"""
-        if self.path == '/enhance':
+        if self.path == '/enhance_raw':
+            self.handle_enhance_request(raw=True)
+        elif self.path == '/enhance':
             self.handle_enhance_request()
         else:
             self.send_error(404, "Endpoint not found")
     
-    def serve_file(self, file_path):
+    def serve_file(self, file_path, cache=False):
         """تقديم ملف"""
         try:
             if not os.path.isabs(file_path):
-                file_path = self.base_path / file_path
+                file_path = os.path.join(BASE_PATH, file_path)
             
-            with open(file_path, 'rb') as f:
-                content = f.read()
+            if not cache:
+                # تحديد نوع المحتوى
+                content_type = guess_content_type(os.path.splitext(file_path)[1].lower())
+                
+                # إرسال الملف من القرص مباشرة دون تحميله إلى الذاكرة
+                with open(file_path, 'rb') as f:
+                    stat = os.fstat(f.fileno())
+                    size = stat.st_size
+                    etag = f'"{size:x}-{int(stat.st_mtime):x}"'
+                    
+                    # أسماء النتائج فريدة ومحتواها لا يتغير، فيكفي التحقق بـ ETag
+                    if self.headers.get('If-None-Match') == etag:
+                        self.send_response(304)
+                        self.send_header('ETag', etag)
+                        self.send_header('Cache-Control', 'public, max-age=31536000, immutable')
+                        self.end_headers()
+                        return
+                    
+                    self.send_response(200)
+                    self.send_header('Content-Type', content_type)
+                    self.send_header('Content-Length', str(size))
+                    self.send_header('ETag', etag)
+                    self.send_header('Cache-Control', 'public, max-age=31536000, immutable')
+                    self.send_header('Access-Control-Allow-Origin', '*')
+                    self.end_headers()
+                    self.send_file_body(f, size)
+                return
             
-            # تحديد نوع المحتوى
-            content_type, _ = mimetypes.guess_type(str(file_path))
-            if content_type is None:
-                content_type = 'application/octet-stream'
+            content, content_type = load_static_file(file_path)
             
             self.send_response(200)
             self.send_header('Content-Type', content_type)
@@ -70,56 +489,66 @@ class RealESRGANHandler(BaseHTTPRequestHandler):
             print(f"Error serving file: {e}")
             self.send_error(500, "Internal server error")
     
-    def handle_enhance_request(self):
-        """معالجة طلب تحسين الصورة"""
+    def send_file_body(self, f, size):
+        """نسخ محتوى الملف إلى المقبس (sendfile حيث يتوفر)"""
+        if hasattr(os, 'sendfile'):
+            if hasattr(os, 'posix_fadvise'):
+                # قراءة مسبقة تسلسلية لملف سيُرسل كاملاً (مجرد تلميح، فلا يُعد فشله خطأ)
+                try:
+                    os.posix_fadvise(f.fileno(), 0, size, os.POSIX_FADV_SEQUENTIAL)
+                except OSError:
+                    pass
+            self.wfile.flush()
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(self.connection.fileno(), f.fileno(), offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        else:
+            shutil.copyfileobj(f, self.wfile, 1 << 20)
+    
+    def handle_enhance_request(self, raw=False):
+        """معالجة طلب تحسين الصورة (JSON بترميز base64، أو بايتات الصورة مباشرة إن كان raw)"""
+        input_path = None
         try:
-            # قراءة البيانات
             content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
             
-            # تحليل JSON
-            data = json.loads(post_data.decode('utf-8'))
-            image_data = data.get('image')
-            
-            if not image_data:
-                self.send_json_response({'error': 'لم يتم العثور على بيانات الصورة'}, 400)
-                return
-            
-            # فك تشفير الصورة من base64
-            try:
-                # إزالة البادئة data:image/...;base64,
-                if ',' in image_data:
-                    image_data = image_data.split(',')[1]
-                
-                image_bytes = base64.b64decode(image_data)
-            except Exception as e:
-                self.send_json_response({'error': f'خطأ في فك تشفير الصورة: {str(e)}'}, 400)
+            if raw and not self.headers.get('Content-Type', '').startswith('image/'):
+                self.send_json_response(ERROR_NOT_IMAGE, 415)
                 return
             
             # إنشاء ملف مؤقت للصورة
-            temp_dir = self.base_path / 'temp'
-            temp_dir.mkdir(exist_ok=True)
+            temp_dir = os.path.join(BASE_PATH, 'temp')
             
-            input_filename = f"input_{uuid.uuid4().hex}.jpg"
-            output_filename = f"output_{uuid.uuid4().hex}.jpg"
+            input_filename = f"input_{secrets.token_urlsafe(12)}.jpg"
+            # إخراج webp (أصغر وأسرع ترميزاً) إن كان المتصفح يقبله
+            output_ext = 'webp' if 'image/webp' in self.headers.get('Accept', '') else 'jpg'
+            output_filename = f"output_{secrets.token_urlsafe(12)}.{output_ext}"
             
-            input_path = temp_dir / input_filename
-            output_path = self.base_path / 'results' / output_filename
+            input_path = os.path.join(temp_dir, input_filename)
+            output_path = os.path.join(BASE_PATH, 'results', output_filename)
             
-            # حفظ الصورة المدخلة
-            with open(input_path, 'wb') as f:
-                f.write(image_bytes)
+            # حفظ الصورة في الملف المؤقت (مع فك تشفير base64 على دفعات لطلبات JSON)
+            try:
+                if raw:
+                    image_size = self.receive_raw_image(content_length, input_path)
+                else:
+                    image_size = self.receive_image(content_length, input_path)
+            except json.JSONDecodeError:
+                raise
+            except ValueError as e:
+                self.send_json_response({'error': f'خطأ في فك تشفير الصورة: {str(e)}'}, 400)
+                return
             
-            # تشغيل Real-ESRGAN
-            success, error_msg = self.run_realesrgan(str(input_path), str(output_path))
+            if not image_size:
+                self.send_json_response(ERROR_NO_IMAGE, 400)
+                return
             
-            # تنظيف الملف المؤقت
-            try:
-                input_path.unlink()
-            except:
-                pass
+            # تشغيل Real-ESRGAN
+            success, error_msg = self.run_realesrgan(input_path, output_path)
             
-            if success and output_path.exists():
+            if success:
                 # إرجاع مسار الصورة المحسنة
                 result_url = f'/results/{output_filename}'
                 self.send_json_response({
@@ -133,55 +562,109 @@ class RealESRGANHandler(BaseHTTPRequestHandler):
                 }, 500)
                 
         except json.JSONDecodeError:
-            self.send_json_response({'error': 'بيانات JSON غير صالحة'}, 400)
+            self.send_json_response(ERROR_INVALID_JSON, 400)
         except Exception as e:
             print(f"Error in enhance request: {e}")
             self.send_json_response({'error': f'خطأ في الخادم: {str(e)}'}, 500)
+        finally:
+            # تنظيف الملف المؤقت
+            if input_path is not None:
+                try:
+                    os.unlink(input_path)
+                except OSError:
+                    pass
+    
+    def receive_raw_image(self, content_length, input_path):
+        """نسخ بايتات الصورة من جسم الطلب إلى الملف، وإرجاع حجمها"""
+        remaining = content_length
+        with open(input_path, 'wb') as f:
+            while remaining > 0:
+                data = self.rfile.read(min(remaining, STREAM_CHUNK_SIZE))
+                if not data:
+                    raise ValueError('Unexpected end of body')
+                f.write(data)
+                remaining -= len(data)
+        return content_length
+    
+    def receive_image(self, content_length, input_path):
+        """قراءة الصورة من الطلب وفك تشفيرها على دفعات إلى الملف، وإرجاع حجمها"""
+        head = self.rfile.read(min(content_length, ENVELOPE_HEAD_SIZE))
+        remaining = content_length - len(head)
+        start = find_image_payload(head)
+        
+        if start < 0:
+            # غلاف JSON غير متوقع: الرجوع إلى التحليل الكامل
+            post_data = head + self.rfile.read(remaining)
+            data = json.loads(post_data.decode('utf-8'))
+            image_data = data.get('image')
+            if not image_data:
+                return 0
+            # إزالة البادئة data:image/...;base64, (قد تطول بمعاملات مثل name=)؛
+            # الفاصلة قريبة من البداية فلا يُمسح باقي السلسلة
+            if image_data.startswith('data:'):
+                image_data = image_data.partition(',')[2]
+            image_bytes = b64decode(image_data, validate=False)
+            with open(input_path, 'wb') as f:
+                f.write(image_bytes)
+            return len(image_bytes)
+        
+        written = 0
+        pending = head[start:]
+        with open(input_path, 'wb') as f:
+            while True:
+                end = find_string_end(pending)
+                if end >= 0:
+                    # نهاية سلسلة base64
+                    chunk = b64decode(unescape_base64(pending[:end]), validate=False)
+                    f.write(chunk)
+                    written += len(chunk)
+                    break
+                
+                # إبقاء تهريب غير مكتمل في آخر الدفعة مع الدفعة التالية
+                split = incomplete_escape_start(pending)
+                pending, carry = unescape_base64(pending[:split]), pending[split:]
+                
+                # فك تشفير الجزء المكتمل (مضاعفات 4 أحرف) والاحتفاظ بالباقي
+                usable = len(pending) - len(pending) % 4
+                chunk = b64decode(pending[:usable], validate=False)
+                f.write(chunk)
+                written += len(chunk)
+                pending = pending[usable:] + carry
+                
+                if remaining <= 0:
+                    raise json.JSONDecodeError('Unterminated string', '', 0)
+                data = self.rfile.read(min(remaining, STREAM_CHUNK_SIZE))
+                if not data:
+                    raise json.JSONDecodeError('Unexpected end of body', '', 0)
+                remaining -= len(data)
+                pending += data
+        
+        # تجاهل بقية الغلاف
+        if remaining > 0:
+            self.rfile.read(remaining)
+        return written
     
     def run_realesrgan(self, input_path, output_path):
-        """تشغيل Real-ESRGAN"""
+        """تشغيل Real-ESRGAN (النجاح يعني أن الصورة المحسنة موجودة في output_path)"""
         try:
-            # التأكد من وجود المجلد
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
-            
-            # تشغيل Real-ESRGAN NCNN
-            exe_path = self.base_path / 'realesrgan-ncnn-vulkan.exe'
+            # تفضيل النموذج المحمّل داخل العملية إن توفر
+            upsampler = load_upsampler()
+            if upsampler is not None:
+                return run_upsampler(upsampler, input_path, output_path)
             
-            if not exe_path.exists():
+            if not BATCHER.exe_path.exists():
                 return False, "ملف Real-ESRGAN غير موجود"
             
-            cmd = [
-                str(exe_path),
-                '-i', input_path,
-                '-o', output_path,
-                '-n', 'realesrgan-x4plus',
-                '-t', '256',  # تقليل حجم البلاط لتسريع المعالجة
-                '-j', '1:1:1'  # استخدام خيط واحد لكل GPU لتحسين الاستقرار
-            ]
-            
-            print(f"Running command: {' '.join(cmd)}")
-            
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                cwd=str(self.base_path)
-            )
-            
-            if result.returncode == 0:
-                return True, None
-            else:
-                error_msg = result.stderr or result.stdout or "خطأ غير معروف"
-                print(f"Real-ESRGAN error: {error_msg}")
-                return False, error_msg
+            # تشغيل Real-ESRGAN NCNN ضمن دفعة مشتركة
+            return BATCHER.submit(input_path, output_path)
                 
         except Exception as e:
             print(f"Exception in run_realesrgan: {e}")
             return False, str(e)
     
     def send_json_response(self, data, status_code=200):
-        """إرسال استجابة JSON"""
-        response = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        """إرسال استجابة JSON (كائن، أو بايتات مرمّزة مسبقاً)"""
+        response = data if isinstance(data, bytes) else dumps_json(data)
         
         self.send_response(status_code)
         self.send_header('Content-Type', 'application/json; charset=utf-8')
@@ -201,9 +684,14 @@ class RealESRGANHandler(BaseHTTPRequestHandler):
         self.end_headers()
     
     def log_message(self, format, *args):
-        """تسجيل الرسائل"""
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        print(f"[{timestamp}] {format % args}")
+        """تسجيل الطلبات (يُنسق ويُكتب لاحقاً من خيط السجل)"""
+        if ACCESS_LOG:
+            LOG_BUFFER.append((time.time(), format, args))
+    
+    def log_error(self, format, *args):
+        """تسجيل الأخطاء فوراً، بغض النظر عن ACCESS_LOG"""
+        sys.stdout.write(format_log_line(time.time(), format, args))
+        sys.stdout.flush()
 
 def main():
     """تشغيل الخادم"""
@@ -211,12 +699,21 @@ def main():
     port = int(os.environ.get('PORT', 8080))
     host = '0.0.0.0'  # للسماح بالاتصالات الخارجية في البيئة السحابية
     
-    # التأكد من وجود مجلد النتائج
-    results_dir = Path('results')
-    results_dir.mkdir(exist_ok=True)
+    # التأكد من وجود مجلدي النتائج والملفات المؤقتة
+    os.makedirs(os.path.join(BASE_PATH, 'results'), exist_ok=True)
+    os.makedirs(os.path.join(BASE_PATH, 'temp'), exist_ok=True)
+    
+    # تحميل الواجهة إلى الذاكرة مسبقاً
+    load_static_file(os.path.join(BASE_PATH, 'web_interface.html'))
+    
+    # تحميل النموذج مسبقاً حتى لا يدفع أول طلب كلفة التحميل
+    load_upsampler()
+    
+    # تشغيل خيط كتابة السجل
+    threading.Thread(target=log_writer, daemon=True).start()
     
     # إنشاء الخادم
-    server = HTTPServer((host, port), RealESRGANHandler)
+    server = RealESRGANServer((host, port), RealESRGANHandler)
     
     print(f"🚀 Real-ESRGAN Web Server بدأ التشغيل على:")
     print(f"   http://{host}:{port}")
@@ -226,6 +723,7 @@ def main():
     try:
         server.serve_forever()
     except KeyboardInterrupt:
+        flush_log_buffer()
         print("\n🛑 تم إيقاف الخادم")
         server.shutdown()
 